@@ -0,0 +1,41 @@
+# cython: language_level=3, boundscheck=False, wraparound=False, cdivision=True
+"""
+Compiled SMB recurrence for installs without numba, see `smb_for_LRP`
+"""
+
+
+cdef void _smb_recurrence(const double[::1] ppt_after_ro, const double[::1] et, const double[::1] eff_ppt,
+                          double cap, double init, double[::1] ss, double[::1] cu_ss) noexcept nogil:
+    """Soil storage recurrence of a field, as `smb_for_LRP._smb_recurrence`"""
+    cdef Py_ssize_t t, n = et.shape[0]
+    cdef double cu, prev_ss, ss_before_CU
+    if n == 0:
+        return
+
+    # no precipitation is added to the initial soil storage
+    cu = et[0] - eff_ppt[0]
+    if cu > init:
+        cu = init
+    prev_ss = init - cu
+    cu_ss[0] = cu
+    ss[0] = prev_ss
+    for t in range(1, n):
+        ss_before_CU = prev_ss + ppt_after_ro[t]
+        if ss_before_CU > cap:
+            ss_before_CU = cap
+        cu = et[t] - eff_ppt[t]
+        if cu > ss_before_CU:
+            cu = ss_before_CU
+        prev_ss = ss_before_CU - cu
+        cu_ss[t] = cu
+        ss[t] = prev_ss
+
+
+def smb_recurrence_rows(const double[:, ::1] ppt_after_ro, const double[:, ::1] et, const double[:, ::1] eff_ppt,
+                        double cap, double init, double[:, ::1] ss, double[:, ::1] cu_ss):
+    """Soil storage recurrence over the rows of 2-D arrays, one field per row, as
+    `smb_for_LRP._smb_recurrence_rows`. Runs without the GIL"""
+    cdef Py_ssize_t i
+    with nogil:
+        for i in range(et.shape[0]):
+            _smb_recurrence(ppt_after_ro[i], et[i], eff_ppt[i], cap, init, ss[i], cu_ss[i])
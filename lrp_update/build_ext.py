@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+"""
+Ahead-of-time build of the SMB recurrence kernel, so the reports neither import numba nor pay for its JIT warmup.
+
+The kernel is compiled from `smb_for_LRP._smb_recurrence_rows`, the same source the numba backend runs.
+setup.py builds it with the package when numba.pycc and a C compiler are available, or run
+`python -m lrp_update.build_ext` to build `lrp_update/smb_aot` in place.
+"""
+import os
+
+from numba.pycc import CC
+
+# the kernels are compiled from their numba definitions, not from an existing build. The backend is
+# only set for this import, the rest of the process keeps the one it asked for
+_requested_backend = os.environ.get('LRP_UPDATE_SMB_BACKEND')
+os.environ['LRP_UPDATE_SMB_BACKEND'] = 'numba'
+try:
+    from lrp_update import smb_for_LRP
+finally:
+    if _requested_backend is None:
+        del os.environ['LRP_UPDATE_SMB_BACKEND']
+    else:
+        os.environ['LRP_UPDATE_SMB_BACKEND'] = _requested_backend
+
+if smb_for_LRP.BACKEND != 'numba':
+    raise ImportError(f"smb_for_LRP was already imported with the {smb_for_LRP.BACKEND} backend")
+
+cc = CC('smb_aot')
+cc.export('smb_recurrence_rows', 'void(f8[:,::1],f8[:,::1],f8[:,::1],f8,f8,f8[:,::1],f8[:,::1])')(
+    smb_for_LRP._smb_recurrence_rows.py_func)
+
+if __name__ == '__main__':
+    cc.compile()
@@ -2,25 +2,157 @@
 Author: Marco Maneta
 email: mmaneta@ekiconsult.com
 """
+import asyncio
 import datetime
+import hashlib
+import io
+import json
+import multiprocessing
 import os
+import re
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 import fpdf
-import matplotlib.pyplot as plt
+import matplotlib
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
 import pypdf
 import requests
-from PIL import Image
 from fpdf import FPDF
 from fpdf.fonts import FontFace
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
 # Import Chris Heppner's SMB functions
-from lrp_update.smb_for_LRP import calc_SMB_for_time_series as smb
-from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
+from lrp_update.smb_for_LRP import (INITIAL_SOIL_STOR, KERNEL_RELEASES_GIL, RUNOFF_FRACTION, SOIL_STOR_CAP,
+                                     smb_gufunc, smb_rows)
 
 INCHES_TO_FEET = 1. / 12.
 FEET_TO_INCHES = 12.
 
+# report plot font, applied only while the report plot is drawn
+PLOT_RC = {'font.weight': 'bold', 'font.size': 16}
+
+# explicit schemas so pyarrow skips type inference and parses dates in the reader
+# OpenET values have a few significant digits, float32 halves the memory of the datasets
+OPENET_COLUMN_TYPES = {'time': pa.timestamp('ns'),
+                       'EKIfld': pa.int32(),
+                       'et': pa.float32(),
+                       'pr': pa.float32(),
+                       'acre-feet': pa.float32(),
+                       'acres': pa.float32()}
+OPENET_DTYPES = {'EKIfld': 'int32', 'et': 'float32', 'pr': 'float32', 'acre-feet': 'float32', 'acres': 'float32'}
+FLD_KEY_COLUMN_TYPES = {'EKIfld': pa.int32(),
+                        'concat_appl_ID': pa.string()}
+
+# `key: value` lines of the pdf reports and the keys used to build a report
+PDF_INFO_LINE = re.compile(r'^([^:\n]*):([^:\n]*)$', re.MULTILINE)
+PDF_INFO_KEYS = ("LRPAgreementNumber",
+                 "LRPParticipantName",
+                 "AreaofLandRepurposed",
+                 "MinimumWaterUseReduction",
+                 "BaselineWaterUse",
+                 "MaximumConsumptiveUse")
+
+
+def _read_csv(fn, column_types):
+    """Reads a csv file with the pyarrow reader and returns a pandas DataFrame.
+
+    Args:
+        fn (str): Path to the csv file.
+        column_types (dict): pyarrow types for the columns with known types.
+
+    Returns:
+        pd.DataFrame: The contents of the file. Unnamed index columns are dropped.
+    """
+    convert_options = pa_csv.ConvertOptions(column_types=column_types,
+                                            timestamp_parsers=[pa_csv.ISO8601, '%m/%d/%Y'])
+    df = pa_csv.read_csv(fn, convert_options=convert_options).to_pandas()
+    return df.drop(columns=[c for c in df.columns if c == ''])
+
+
+def _parse_date(value):
+    try:
+        return datetime.datetime.fromisoformat(value)
+    except ValueError:
+        return datetime.datetime.strptime(value, '%m/%d/%Y')
+
+
+def _csv_time_bounds(fn, tail_size=4096):
+    """Returns the time range of a csv dataset looking only at its first and last rows.
+
+    Datasets are appended in time order, so the first and last rows span the
+    period in the file. If they were not, the returned range is narrower than the
+    real one and the caller just requests data it already has.
+
+    Args:
+        fn (str): Path to the csv dataset.
+        tail_size (int): Number of bytes read from the end of the file to find the last row.
+
+    Returns:
+        tuple: (min time, max time) as pd.Timestamp, or None if the file has no data rows.
+    """
+    with open(fn, 'rb') as f:
+        header = f.readline().decode().strip().split(',')
+        first = f.readline().decode().strip()
+        if not first:
+            return None
+        f.seek(0, io.SEEK_END)
+        f.seek(max(f.tell() - tail_size, 0))
+        last = f.read().decode().strip().splitlines()[-1]
+
+    i_time = header.index('time')
+    times = [pd.Timestamp(_parse_date(line.split(',')[i_time])) for line in (first, last)]
+    return min(times), max(times)
+
+
+def _covers(time_bounds, start_date, end_date):
+    """True if the (min time, max time) `time_bounds` span the period from `start_date` to `end_date`"""
+    return time_bounds is not None and time_bounds[0] <= pd.to_datetime(start_date) \
+        and time_bounds[1] >= pd.to_datetime(end_date)
+
+
+def _csv_can_append(fn, columns):
+    """True if rows with `columns` and ISO dates can be appended to the csv file `fn`.
+
+    Files with other date formats (e.g. m/d/Y) are rewritten instead, so that they
+    never end up with mixed date formats.
+    """
+    with open(fn, 'rb') as f:
+        header = f.readline().decode().strip().split(',')
+        first = f.readline().decode().strip()
+        f.seek(-1, io.SEEK_END)
+        ends_with_newline = f.read(1) == b'\n'
+    if not ends_with_newline or header != list(columns):
+        return False
+    if not first:
+        return True
+    try:
+        datetime.date.fromisoformat(first.split(',')[header.index('time')])
+    except ValueError:
+        return False
+    return True
+
+
+def _read_dataset(fn_csv):
+    """Reads an OpenET dataset, preferring the parquet copy stored next to the csv file.
+
+    The parquet file is only used if it is at least as recent as the csv file, so
+    csv files edited by hand are not shadowed by an outdated copy.
+
+    Args:
+        fn_csv (str): Path to the csv dataset.
+
+    Returns:
+        pd.DataFrame: The dataset.
+    """
+    fn_pq = os.path.splitext(fn_csv)[0] + '.parquet'
+    if os.path.exists(fn_pq) and (not os.path.exists(fn_csv) or
+                                  os.path.getmtime(fn_pq) >= os.path.getmtime(fn_csv)):
+        return pd.read_parquet(fn_pq)
+    return _read_csv(fn_csv, OPENET_COLUMN_TYPES)
+
 
 class OpenetApi:
     """Manages connections with the OpenET
@@ -95,33 +227,10 @@ class OpenetApi:
         Raises:
             Exception: If the query type is not supported.
         """
-        # e.g. Year1_enrolled_nonrepurposed
-        year, enrolled, repurposed = asset_id.split('/')[-1].split('_')
-
-        match query_type:
-            case "multipolygon":
-                url = "https://openet-api.org/raster/timeseries/multipolygon"
-                fn_ds = os.path.join(self.path_dataset, asset_id.split('/')[-1] + f"_{variable}.csv")
-            case _:
-                raise Exception(f"query type {query_type} not supported")
-
-        df_dataset = None
-        try:
-            df_dataset = pd.read_csv(fn_ds)
-            df_dataset['time'] = pd.to_datetime(df_dataset['time'])
-        except FileNotFoundError as e:
-            pass
-
-        # if pd_dataset exists, check if the requested dates are already there
-        if df_dataset is not None:
-            is_within_range = df_dataset['time'].min().asm8 <= pd.to_datetime(
-                start_date) and df_dataset['time'].max().asm8 >= pd.to_datetime(end_date)
-            if is_within_range:
-                print(f"Requested data range {start_date}:{end_date} already in {fn_ds}")
-                return
-            else:
-                print(f"Requested data for period {start_date}:{end_date} extends "
-                      f"beyond data available locally for variable {variable}")
+        url, fn_ds = self._query_target(variable, asset_id, query_type)
+        is_within_range, time_bounds = self._check_local_dataset(fn_ds, variable, start_date, end_date)
+        if is_within_range:
+            return
 
         print(f"Requesting new available data for {variable}...")
 
@@ -138,6 +247,11 @@ class OpenetApi:
                                          file_format,
                                          )
 
+        fn_cache = self._cache_file(args)
+        if self._is_cached(fn_cache, start_date, end_date):
+            print(f"Using cached response {fn_cache}")
+            return self._update_from_response({'url': fn_cache}, fn_ds, time_bounds)
+
         resp = requests.post(
             headers=header,
             json=args,
@@ -149,16 +263,181 @@ class OpenetApi:
         print(f"Request Successful. Retrieving data")
         r = resp.json()
 
-        self.df_data = pd.read_csv(r['url'])
-        self.df_data['time'] = pd.to_datetime(self.df_data['time'])
+        return self._update_from_response(r, fn_ds, time_bounds, fn_cache, (start_date, end_date))
+
+    def update_local_datasets(self, jobs, max_connections=8):
+        """
+        Updates several local datasets, querying the OpenET server concurrently.
+
+        Args:
+            jobs (list): dictionaries with the arguments of `update_local_dataset`, one per dataset.
+            max_connections (int, optional): Maximum simultaneous connections to the server. Defaults to 8.
+
+        Returns:
+            list: The updated datasets, None for datasets that were already up to date.
+
+        Raises:
+            Exception: If called from a running event loop (e.g. a Jupyter notebook),
+                where `await update_local_datasets_async(jobs)` must be used instead.
+        """
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(self.update_local_datasets_async(jobs, max_connections))
+        raise Exception("update_local_datasets cannot run inside a running event loop, "
+                        "use `await update_local_datasets_async(jobs)` instead")
+
+    async def update_local_datasets_async(self, jobs, max_connections=8):
+        """Asynchronous version of `update_local_datasets`. Requires aiohttp."""
+        try:  # imported here, it is only needed to update several datasets and is slow to import
+            import aiohttp
+        except ImportError:
+            raise ImportError("update_local_datasets requires aiohttp, install it with `pip install aiohttp`")
+
+        datasets = [None] * len(jobs)
+        pending = []
+        for i, job in enumerate(jobs):
+            job = dict(job)
+            query_type = job.pop("query_type", "multipolygon")
+            url, fn_ds = self._query_target(job["variable"], job.get("asset_id"), query_type)
+            is_within_range, time_bounds = self._check_local_dataset(fn_ds, job["variable"],
+                                                                     job["start_date"], job["end_date"])
+            if is_within_range:
+                continue
+            header, args = self._build_query(**{"asset_id": None, "file_format": "JSON", **job})
+            fn_cache = self._cache_file(args)
+            if self._is_cached(fn_cache, job["start_date"], job["end_date"]):
+                print(f"Using cached response {fn_cache}")
+                datasets[i] = self._update_from_response({'url': fn_cache}, fn_ds, time_bounds)
+            else:
+                pending.append((i, url, fn_ds, time_bounds, fn_cache, header, args))
+
+        print(f"Requesting new available data for {len(pending)} datasets...")
+        connector = aiohttp.TCPConnector(limit_per_host=max_connections)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            responses = await asyncio.gather(*[self._query_async(session, header, args, url)
+                                               for _, url, _, _, _, header, args in pending])
+
+        for (i, _, fn_ds, time_bounds, fn_cache, _, args), df_data in zip(pending, responses):
+            datasets[i] = self._update_from_data(df_data, fn_ds, time_bounds, fn_cache, args["date_range"])
+
+        return datasets
+
+    @classmethod
+    async def _query_async(cls, session, header, args, url):
+        """Posts a query to the OpenET server and downloads the csv file of the response"""
+        r = await cls._post_async(session, header, args, url)
+        return await cls._download_async(session, r)
+
+    @staticmethod
+    async def _download_async(session, r):
+        """Reads the csv file of an OpenET response, downloading it through `session` if remote"""
+        if not r['url'].startswith(('http://', 'https://')):
+            return pd.read_csv(r['url'], dtype=OPENET_DTYPES)
+        async with session.get(r['url']) as resp:
+            resp.raise_for_status()
+            return pd.read_csv(io.BytesIO(await resp.read()), dtype=OPENET_DTYPES)
+
+    @staticmethod
+    async def _post_async(session, header, args, url, max_retries=5):
+        """Posts a query to the OpenET server, retrying with exponential back-off
+        when the server is busy (429) or fails (5xx)"""
+        for attempt in range(max_retries):
+            async with session.post(url, headers=header, json=args) as resp:
+                if resp.status == 200:
+                    return await resp.json(content_type=None)
+                text = await resp.text()
+                if resp.status != 429 and resp.status < 500:
+                    raise Exception(text)
+            await asyncio.sleep(2 ** attempt)
+        raise Exception(text)
+
+    def _query_target(self, variable, asset_id, query_type):
+        # e.g. Year1_enrolled_nonrepurposed
+        year, enrolled, repurposed = asset_id.split('/')[-1].split('_')
+
+        match query_type:
+            case "multipolygon":
+                url = "https://openet-api.org/raster/timeseries/multipolygon"
+                fn_ds = os.path.join(self.path_dataset, asset_id.split('/')[-1] + f"_{variable}.csv")
+            case _:
+                raise Exception(f"query type {query_type} not supported")
+
+        return url, fn_ds
+
+    @staticmethod
+    def _check_local_dataset(fn_ds, variable, start_date, end_date):
+        time_bounds = None
+        try:
+            time_bounds = _csv_time_bounds(fn_ds)
+        except FileNotFoundError as e:
+            pass
+
+        # if the local dataset exists, check if the requested dates are already there
+        is_within_range = _covers(time_bounds, start_date, end_date)
+        if time_bounds is not None:
+            if is_within_range:
+                print(f"Requested data range {start_date}:{end_date} already in {fn_ds}")
+            else:
+                print(f"Requested data for period {start_date}:{end_date} extends "
+                      f"beyond data available locally for variable {variable}")
+
+        return is_within_range, time_bounds
 
-        if df_dataset is not None:
-            df_dataset = pd.concat([df_dataset, self.df_data], ignore_index=True).drop_duplicates(subset=['time', 'EKIfld'],
-                                                                                                  keep='first')
+    def _cache_file(self, args):
+        """Path of the cached response to a query, named after the hash of the query arguments"""
+        key = hashlib.sha1(json.dumps(args, sort_keys=True).encode()).hexdigest()
+        return os.path.join(self.path_dataset, '.cache', key + '.csv')
+
+    @staticmethod
+    def _is_cached(fn_cache, start_date, end_date):
+        """True if there is a cached response covering the period from `start_date` to `end_date`"""
+        return os.path.exists(fn_cache) and _covers(_csv_time_bounds(fn_cache), start_date, end_date)
+
+    def _update_from_response(self, r, fn_ds, time_bounds, fn_cache=None, date_range=None):
+        if r['url'].startswith(('http://', 'https://')):
+            # parse the csv while it downloads
+            with requests.get(r['url'], stream=True) as resp:
+                resp.raise_for_status()
+                resp.raw.decode_content = True
+                df_data = pd.read_csv(resp.raw, dtype=OPENET_DTYPES)
         else:
-            df_dataset = self.df_data
+            df_data = pd.read_csv(r['url'], dtype=OPENET_DTYPES)
+        return self._update_from_data(df_data, fn_ds, time_bounds, fn_cache, date_range)
 
-        df_dataset.to_csv(fn_ds, index=False)
+    def _update_from_data(self, df_data, fn_ds, time_bounds, fn_cache=None, date_range=None):
+        self.df_data = df_data
+        try:
+            self.df_data['time'] = pd.to_datetime(self.df_data['time'], format='%Y-%m-%d', cache=True)
+        except ValueError:  # not the ISO dates returned by OpenET, let pandas work out the format
+            self.df_data['time'] = pd.to_datetime(self.df_data['time'], cache=True)
+
+        # cache only complete responses, a partial one would be replayed instead of asking for the missing data
+        time_range = (self.df_data['time'].min(), self.df_data['time'].max())
+        if fn_cache is not None and _covers(time_range, *date_range):
+            os.makedirs(os.path.dirname(fn_cache), exist_ok=True)
+            self.df_data.to_csv(fn_cache, index=False)
+
+        if time_bounds is not None:
+            df_dataset = _read_dataset(fn_ds)
+            # keep the local records, add only the (time, EKIfld) pairs not already there
+            key = ['time', 'EKIfld']
+            is_new = ~self.df_data.set_index(key).index.isin(df_dataset.set_index(key).index)
+            df_new = self.df_data[is_new].sort_values('time', kind='stable')
+            df_dataset = pd.concat([df_dataset, df_new], ignore_index=True)
+        else:
+            df_new = df_dataset = self.df_data.sort_values('time', kind='stable', ignore_index=True)
+
+        # append only new records that come after the local ones, so the csv stays in time order
+        # (see `_csv_time_bounds`), and only if the csv columns and dates match the OpenET ones
+        is_new_file = not os.path.exists(fn_ds)
+        is_after = time_bounds is None or df_new.empty or df_new['time'].min() > time_bounds[1]
+        if is_new_file or (is_after and _csv_can_append(fn_ds, df_new.columns)):
+            df_new.to_csv(fn_ds, mode='a', header=is_new_file, index=False, float_format='%.4f')
+        else:
+            df_dataset = df_dataset.sort_values('time', kind='stable', ignore_index=True)
+            df_dataset.to_csv(fn_ds, index=False, float_format='%.4f')
+        df_dataset.to_parquet(os.path.splitext(fn_ds)[0] + '.parquet', compression='zstd', index=False)
 
         return df_dataset
 
@@ -195,6 +474,56 @@ class OpenetApi:
         return header, dct_query
 
 
+def _n_workers(max_workers):
+    """Number of worker processes for `max_workers`, counting negative values back from the cpu count"""
+    n_cpus = os.cpu_count() or 1
+    if max_workers is None:
+        return n_cpus
+    if max_workers < 0:
+        return max(1, n_cpus + 1 + max_workers)
+    return max_workers
+
+
+def _smb_block(pp_2d, et_2d, kernel=smb_gufunc):
+    """Runs the SMB for the parcels in the rows of `pp_2d` and `et_2d` with a single kernel call
+
+    Returns:
+        The ss, ppt_eff, runoff, cons_use_ss, cons_use_AW and cons_use_ppt arrays of the parcels
+    """
+    eff_ppt, ro, cu_ss, ss, cu_aw, cu_ppt = kernel(pp_2d, et_2d, RUNOFF_FRACTION, SOIL_STOR_CAP, INITIAL_SOIL_STOR)
+    return ss, eff_ppt, ro, cu_ss, cu_aw, cu_ppt
+
+
+def _smb_thread_worker(block):
+    """Runs the SMB for a block of parcels in a worker thread, with the serial kernel that releases the GIL"""
+    return _smb_block(*block, kernel=smb_rows)
+
+
+def _smb_worker(block):
+    """Runs the SMB for a block of parcels in a worker process, sending back float32 results"""
+    return tuple(values.astype(np.float32) for values in _smb_block(*block))
+
+
+def _parcel_rows(fld_ds, fld, parcel, n_parcels):
+    """Rows of the fields of each parcel in a dataset sorted by field.
+
+    Args:
+        fld_ds (np.ndarray): Sorted `EKIfld` of the dataset rows.
+        fld (np.ndarray): `EKIfld` of the fields in the parcels.
+        parcel (np.ndarray): Parcel code of each of the fields in `fld`, from 0 to `n_parcels` - 1.
+        n_parcels (int): Number of parcels.
+
+    Returns:
+        tuple: (dataset rows, parcel code of each row). Fields listed twice for a parcel count once.
+    """
+    fld, parcel = np.divmod(np.unique(fld.astype(np.int64) * n_parcels + parcel), n_parcels)
+    start = np.searchsorted(fld_ds, fld, side='left')
+    n_rows = np.searchsorted(fld_ds, fld, side='right') - start
+    offset = np.cumsum(n_rows) - n_rows
+    rows = np.arange(n_rows.sum()) + np.repeat(start - offset, n_rows)
+    return rows, np.repeat(parcel, n_rows)
+
+
 class _ConsumptiveUse:
     """Internal Class"""
 
@@ -241,25 +570,30 @@ class CalculateWaterBalance:
             print(f"repurposed in {fn_pp} and {fn_et} do not match")
             raise Exception(f"repurposed in {fn_pp} and {fn_et} do not match")
 
-        self.eki_fld_id_keys = pd.read_csv(fn_fld_key)
+        self.eki_fld_id_keys = _read_csv(fn_fld_key, FLD_KEY_COLUMN_TYPES)
         try:
-            self.df_et = pd.read_csv(fn_et)
+            self.df_et = _read_dataset(fn_et)
         except FileNotFoundError as e:
             print(f"File {fn_et} not found.")
             raise
 
         try:
-            self.df_pp = pd.read_csv(fn_pp)
+            self.df_pp = _read_dataset(fn_pp)
         except FileNotFoundError as e:
             print(f"File {fn_pp} not found.")
             raise
 
-        self.df_et['time'] = pd.to_datetime(self.df_et['time'])
-        self.df_pp['time'] = pd.to_datetime(self.df_pp['time'])
-
         self.df_et = self.df_et[self.df_et['time'] <= end_date]
         self.df_pp = self.df_pp[self.df_pp['time'] <= end_date]
 
+        # sort the rows by field, so the rows of a parcel are found with a binary search, and
+        # code the times as positions in `self._times`, once for all the parcels
+        self.df_et = self.df_et.sort_values('EKIfld', kind='stable', ignore_index=True)
+        self.df_pp = self.df_pp.sort_values('EKIfld', kind='stable', ignore_index=True)
+        self._times = pd.DatetimeIndex(np.union1d(self.df_et['time'].to_numpy(), self.df_pp['time'].to_numpy()))
+        self._et = self._index_dataset(self.df_et, self._times)
+        self._pp = self._index_dataset(self.df_pp, self._times)
+
         # Filter keys
         is_repurposed = 'Y' if repurposed == 'repurposed' else 'N'
         self.eki_fld_id_keys = self.eki_fld_id_keys[(self.eki_fld_id_keys['LRP_Yr'] == 'Yr' + str(year[-1])) & (
@@ -271,57 +605,129 @@ class CalculateWaterBalance:
 
     def calculate_consumptive_use(self,
                                   concat_appl_id: str = None,
+                                  max_workers: int = 1,
                                   ):
         """Consumptive use for parcel with id `concat_appl_id`
         Args:
             concat_appl_id (str): The concat_appl_id for the parcel.
+            max_workers (int): Number of threads, or processes with the plain python SMB, that share the parcels.
+                Defaults to 1, which runs in the current thread. None or -1 uses all the cpus, and other
+                negative values all the cpus but `-max_workers - 1`, as `n_jobs` in joblib.
 
         Returns:
             An object of type _ConsumptiveUse that with method to save results to a csv file
         """
         if concat_appl_id is None:
-            self.df_smb = self.eki_fld_id_keys.groupby('concat_appl_ID').apply(self._run_consumptive_use_calcs)
+            fld_keys = self.eki_fld_id_keys
         else:
             fld_keys = self.eki_fld_id_keys[self.eki_fld_id_keys['concat_appl_ID'] == concat_appl_id]
-            self.df_smb = self._run_consumptive_use_calcs(fld_keys)
-            self.df_smb.index = pd.MultiIndex.from_product([[concat_appl_id], self.df_smb.index],
-                                                           names=['concat_appl_id', 'time'])
+        self.df_smb = self._run_consumptive_use_calcs(fld_keys, max_workers)
 
         return _ConsumptiveUse(self.df_smb, self.year, self.end_date, self.repurposed)
 
-    def _run_consumptive_use_calcs(self, fld_keys):
-        df_et = self.df_et[self.df_et['EKIfld'].isin(fld_keys['EKIfld'])]
-        if df_et.size == 0:
-            msg = f"The evapotranspiration dataset does not contain information for fields with ids {fld_keys['EKIfld']}"
-            print(msg)
-            raise Exception(msg)
-        df_et_sum = df_et.groupby('time').sum()
-        df_et_av = df_et_sum['acre-feet'] * FEET_TO_INCHES / df_et_sum['acres']
+    def _run_consumptive_use_calcs(self, fld_keys, max_workers=1):
+        parcel, parcel_ids = pd.factorize(fld_keys['concat_appl_ID'], sort=True)
+        pp_av, has_pp = self._weighted_average(self._pp, fld_keys, parcel, len(parcel_ids), "precipitation")
+        et_av, has_et = self._weighted_average(self._et, fld_keys, parcel, len(parcel_ids), "evapotranspiration")
+
+        # (parcel, time) pairs with both variables, in parcel and time order
+        is_valid = has_pp & has_et
+        row, i_time = np.nonzero(is_valid)
+        print(f"calculating consumptive use for parcels {list(parcel_ids.take(np.unique(row)))}")
+        # left-align the series of each parcel in a (parcel, time) block; padding at the end
+        # does not affect the recurrence so parcels with shorter records are still exact
+        col = np.cumsum(is_valid, axis=1)[row, i_time] - 1
+        pp_2d = np.zeros((len(parcel_ids), col.max() + 1))
+        et_2d = np.zeros_like(pp_2d)
+        pp_2d[row, col] = pp_av[row, i_time]
+        et_2d[row, col] = et_av[row, i_time]
+
+        # fill a single block and wrap it once, so pandas does not rebuild or upcast the columns
+        out = np.empty((len(row), 8), dtype=np.float32)
+        for k, values in enumerate(self._smb(pp_2d, et_2d, max_workers)):
+            out[:, k] = values[row, col]
+        out[:, 6] = pp_2d[row, col]
+        out[:, 7] = et_2d[row, col]
+        index = pd.MultiIndex(levels=[parcel_ids, self._times], codes=[row, i_time],
+                              names=['concat_appl_id', 'time'], verify_integrity=False)
+        df_smb = pd.DataFrame(out,
+                              index=index.remove_unused_levels(),
+                              columns=["ss", "ppt_eff", "runoff", "cons_use_ss", "cons_use_AW", "cons_use_ppt",
+                                       "pp_wght_av", "et_wght_av"],
+                              copy=False)
 
-        df_pp = self.df_pp[self.df_pp['EKIfld'].isin(fld_keys['EKIfld'])]
-        if df_pp.size == 0:
-            msg = f"The precipitation dataset does not contain information for fields with ids {fld_keys['EKIfld']}"
-            print(msg)
-            raise Exception(msg)
+        return df_smb
 
-        df_pp_sum = df_pp.groupby('time').sum()
-        df_pp_av = df_pp_sum['acre-feet'] * FEET_TO_INCHES / df_pp_sum['acres']
+    @staticmethod
+    def _smb(pp_2d, et_2d, max_workers):
+        """Runs the SMB for the parcels in the rows of `pp_2d` and `et_2d`, splitting
+        them in one block per worker if `max_workers` is not 1. Returns the arrays of `_smb_block`"""
+        n_blocks = min(len(pp_2d), _n_workers(max_workers))
+        if n_blocks <= 1:
+            return _smb_block(pp_2d, et_2d)
+
+        blocks = zip(np.array_split(pp_2d, n_blocks), np.array_split(et_2d, n_blocks))
+        if KERNEL_RELEASES_GIL:
+            # the compiled kernel releases the GIL, so threads run the blocks without starting processes
+            with ThreadPoolExecutor(n_blocks) as ex:
+                return [np.concatenate(values) for values in zip(*ex.map(_smb_thread_worker, blocks))]
+
+        # the aot and plain python kernels hold the GIL, so only processes run them in parallel;
+        # spawn, since forking a process with numba threads running is not safe
+        with ProcessPoolExecutor(n_blocks, mp_context=multiprocessing.get_context('spawn')) as ex:
+            return [np.concatenate(values) for values in zip(*ex.map(_smb_worker, blocks))]
 
-        print(f"calculating consumptive use for {fld_keys['EKIfld']}")
-        df_smb = pd.DataFrame(
-            smb(df_pp_av.to_numpy(), df_et_av.to_numpy()),
-            index=["ss", "ppt_eff", "runoff", "cons_use_ss", "cons_use_AW", "cons_use_ppt"]
-        ).T
-        df_smb["pp_wght_av"] = df_pp_av.to_numpy()
-        df_smb["et_wght_av"] = df_et_av.to_numpy()
-        df_smb.index = df_pp_av.index
+    @staticmethod
+    def _index_dataset(df, times):
+        """Arrays of an OpenET dataset sorted by field: `EKIfld`, the position of `time` in `times`,
+        `acres` and `acre-feet`. All but the time codes are views of the columns of `df`"""
+        return (df['EKIfld'].to_numpy(),
+                times.get_indexer(df['time']),
+                df['acres'].to_numpy(),
+                df['acre-feet'].to_numpy())
 
-        return df_smb
+    def _weighted_average(self, dataset, fld_keys, parcel, n_parcels, name):
+        """Area weighted average (inches) of the fields in each parcel
+
+        Args:
+            dataset (tuple): OpenET dataset arrays from `_index_dataset`.
+            fld_keys (pd.DataFrame): Fld keys with the `EKIfld` of each `concat_appl_ID`.
+            parcel (np.ndarray): Parcel code of each row of `fld_keys`, from 0 to `n_parcels` - 1.
+            n_parcels (int): Number of parcels.
+            name (str): Name of the variable, used in error messages.
+
+        Returns:
+            tuple: (averages, True where there is data) as (parcel, `self._times`) arrays.
+        """
+        fld_ds, time_ds, acres_ds, af_ds = dataset
+        rows, row_parcel = _parcel_rows(fld_ds, fld_keys['EKIfld'].to_numpy(), parcel, n_parcels)
+
+        # one sum per (parcel, time) cell
+        shape = (n_parcels, len(self._times))
+        cell = row_parcel * shape[1] + time_ds[rows]
+        has_data = np.bincount(cell, minlength=shape[0] * shape[1]).reshape(shape) > 0
+        missing = ~has_data.any(axis=1)[parcel]
+        if len(rows) == 0 or missing.any():
+            ids = fld_keys['EKIfld'] if len(rows) == 0 else fld_keys['EKIfld'][missing]
+            msg = f"The {name} dataset does not contain information for fields with ids {ids}"
+            print(msg)
+            raise Exception(msg)
+
+        # missing values are skipped, as in a groupby sum
+        af_rows, acres_rows = af_ds[rows], acres_ds[rows]
+        af_rows = np.where(np.isfinite(af_rows), af_rows, 0.0)
+        acres_rows = np.where(np.isfinite(acres_rows), acres_rows, 0.0)
+        acre_feet = np.bincount(cell, af_rows, shape[0] * shape[1]).reshape(shape)
+        acres = np.bincount(cell, acres_rows, shape[0] * shape[1]).reshape(shape)
+        average = np.divide(acre_feet * FEET_TO_INCHES, acres, out=np.zeros(shape), where=has_data)
+        return average, has_data
 
 
 class GenerateLrpReport:
     """Handles reading and writing pdf's for report"""
 
+    _figure = None
+
     def __init__(self, lrp_agreement_number,
                  lrp_participant_name,
                  area_of_land_repurposed,
@@ -372,28 +778,11 @@ class GenerateLrpReport:
 
     @staticmethod
     def _parse_pdf_contents(pdf):
+        # the information is in the `key: value` lines of the first page
+        text = pdf.pages[0].extract_text()
+        key_info = {re.sub(r'[^0-9A-Za-z]', '', key): value for key, value in PDF_INFO_LINE.findall(text)}
 
-        pages = [p for p in pdf.pages]
-        key_info = {}
-
-        for p in pages:
-            lines = p.extract_text().splitlines()
-            for line in lines:
-
-                try:
-                    key, value = line.split(':')
-                except ValueError:
-                    key = value = "default"
-                key2 = ''.join(c for c in key if c.isalnum())
-                if key2 in ["LRPAgreementNumber",
-                            "LRPParticipantName",
-                            "AreaofLandRepurposed",
-                            "MinimumWaterUseReduction",
-                            "BaselineWaterUse",
-                            "MaximumConsumptiveUse"]:
-                    key_info[key2] = value
-
-            return key_info
+        return {key: value for key, value in key_info.items() if key in PDF_INFO_KEYS}
 
     def generate_lrp_report(self,
                             fn_pp,
@@ -440,11 +829,12 @@ class GenerateLrpReport:
                                         end_date.strftime("%m-%d-%Y"),
                                         ).calculate_consumptive_use(app_id)
 
-        obj_smb.df_smb['water_year'] = (
-            obj_smb.df_smb.index.levels[1].year.where(obj_smb.df_smb.index.levels[1].month < 10,
-                                                      obj_smb.df_smb.index.levels[1].year + 1))
-        df_wy = obj_smb.df_smb[obj_smb.df_smb['water_year'] == water_year]
-        df_wy.loc[:, ['Q']] = pd.cut(df_wy.index.get_level_values(1).month,
+        t = obj_smb.df_smb.index.get_level_values(1)
+        years, months = t.year, t.month
+        obj_smb.df_smb['water_year'] = years.where(months < 10, years + 1)
+        is_wy = (obj_smb.df_smb['water_year'] == water_year).to_numpy()
+        df_wy = obj_smb.df_smb[is_wy]
+        df_wy.loc[:, ['Q']] = pd.cut(months[is_wy],
                                      bins=[0, 3, 6, 9, 12],
                                      labels=["Q2", "Q3", "Q4", "Q1"],
                                      right=True)
@@ -469,25 +859,27 @@ class GenerateLrpReport:
 
         return obj_smb
 
-    @staticmethod
-    def _plot(df, fn_out=None):
-        font = {
-            'weight': 'bold',
-            'size': 16}
-
-        plt.rc('font', **font)
-
-        fig = plt.figure(figsize=(10, 6), dpi=300)
-        plt.plot(df.index.levels[1], df["et_wght_av"], label="OpenET", marker='o')
-        plt.plot(df.index.levels[1], df["pp_wght_av"], label="Precipitation", marker='o')
-        plt.plot(df.index.levels[1], df["ppt_eff"], label="Effective Precipitation", marker='o')
-        plt.plot(df.index.levels[1], df["cons_use_AW"], label="Consumptive Use of Applied Water", marker='o')
-        plt.ylabel("Amount (inches)")
-        plt.xlabel("Month/Year")
-        plt.grid(True)
-        plt.legend(bbox_to_anchor=(0.5, -0.5), ncols=2, loc='lower center', borderaxespad=0.)
-        plt.title("ET, Consumptive Use, Precipitation, and Effective Precipitation\n on Repurposed Fields")
-        plt.tight_layout()
+    @classmethod
+    def _plot(cls, df, fn_out=None):
+        # the figure is created outside pyplot and reused by all the reports
+        if cls._figure is None:
+            cls._figure = Figure(figsize=(10, 6), dpi=150)
+            FigureCanvasAgg(cls._figure)
+        fig = cls._figure
+        fig.clf()
+
+        with matplotlib.rc_context(PLOT_RC):
+            ax = fig.subplots()
+            ax.plot(df.index.levels[1], df["et_wght_av"], label="OpenET", marker='o')
+            ax.plot(df.index.levels[1], df["pp_wght_av"], label="Precipitation", marker='o')
+            ax.plot(df.index.levels[1], df["ppt_eff"], label="Effective Precipitation", marker='o')
+            ax.plot(df.index.levels[1], df["cons_use_AW"], label="Consumptive Use of Applied Water", marker='o')
+            ax.set_ylabel("Amount (inches)")
+            ax.set_xlabel("Month/Year")
+            ax.grid(True)
+            ax.legend(bbox_to_anchor=(0.5, -0.5), ncols=2, loc='lower center', borderaxespad=0.)
+            ax.set_title("ET, Consumptive Use, Precipitation, and Effective Precipitation\n on Repurposed Fields")
+            fig.tight_layout()
 
         return fig
 
@@ -589,16 +981,24 @@ class Pdf(FPDF):
 
         self.add_page()
 
-        canvas = FigureCanvas(fig)
-        canvas.draw()
-        img = Image.fromarray(np.asarray(canvas.buffer_rgba()))
-        self.image(img, w=self.epw * 0.8, x=fpdf.Align.C)
+        buf = io.BytesIO()
+        # tick labels are only created when the figure is drawn
+        with matplotlib.rc_context(PLOT_RC):
+            fig.savefig(buf, format='png', dpi=150, bbox_inches='tight')
+        buf.seek(0)
+        self.image(buf, w=self.epw * 0.8, x=fpdf.Align.C)
 
     def print_page(self, fn_pdf_report_out, **info):
         self.page_body(**info)
         self.output(fn_pdf_report_out)
 
     def _table(self, df, wy=2023):
+        # format all the values in one go rather than cell by cell
+        values = df[['et_wght_av', 'pp_wght_av', 'cons_use_ppt', 'cons_use_AW', 'cons_use_AW_af',
+                     'total_cons_use_AW_af']].to_numpy(dtype=np.float64)
+        fmt = np.char.mod('%.2f', values)
+        fmt_total = np.char.mod('%.2f', values[:, :5].sum(axis=0))
+
         self.set_font('Helvetica', '', 11.64)
         headings_style = FontFace(emphasis="ITALICS", fill_color=(128, 128, 128))
         with self.table(text_align="CENTER", headings_style=headings_style, num_heading_rows=2) as table:
@@ -615,28 +1015,27 @@ class Pdf(FPDF):
             row.cell("Quarter", align='C')
             row.cell("Months, Year", align='C')
 
-            for months, (i, df_row) in zip([f"Oct-Dec, {wy - 1}", f"Jan-Mar, {wy}", f"Apr-Jun, {wy}", f"Jul-Sep, {wy}"],
-                                           df.iterrows()):
+            for i, (months, quarter) in enumerate(zip([f"Oct-Dec, {wy - 1}", f"Jan-Mar, {wy}", f"Apr-Jun, {wy}",
+                                                       f"Jul-Sep, {wy}"], df["Q"])):
                 row = table.row()
-                row.cell(df_row["Q"], align='C')
+                row.cell(quarter, align='C')
                 row.cell(f"{months}", align='C')
-                row.cell("{:.2f}".format(df_row["et_wght_av"]))
-                row.cell("{:.2f}".format(df_row["pp_wght_av"]))
-                row.cell("{:.2f}".format(df_row["cons_use_ppt"]))
-                #row.cell("{:.2f}".format(df_row["cons_use_AW"]))
-                row.cell("{:.2f}".format(0))  # because applied surface water is zero
-                row.cell("{:.2f}".format(df_row["cons_use_AW"]))
-                row.cell("{:.2f}".format(df_row["cons_use_AW_af"]))
-                row.cell("{:.2f}".format(df_row["total_cons_use_AW_af"]))
+                row.cell(fmt[i, 0])
+                row.cell(fmt[i, 1])
+                row.cell(fmt[i, 2])
+                row.cell("0.00")  # because applied surface water is zero
+                row.cell(fmt[i, 3])
+                row.cell(fmt[i, 4])
+                row.cell(fmt[i, 5])
             row = table.row()
             self.set_font('Helvetica', 'B', 11.64)
             row.cell("Water Year Total", colspan=2)
-            row.cell("{:.2f}".format(df["et_wght_av"].sum()))
-            row.cell("{:.2f}".format(df["pp_wght_av"].sum()))
-            row.cell("{:.2f}".format(df["cons_use_ppt"].sum()))
-            row.cell("{:.2f}".format(0))
-            row.cell("{:.2f}".format(df["cons_use_AW"].sum()))
-            row.cell("{:.2f}".format(df["cons_use_AW_af"].sum()))
-            row.cell("{:.2f}".format(df["cons_use_AW_af"].sum()))
+            row.cell(fmt_total[0])
+            row.cell(fmt_total[1])
+            row.cell(fmt_total[2])
+            row.cell("0.00")
+            row.cell(fmt_total[3])
+            row.cell(fmt_total[4])
+            row.cell(fmt_total[4])
 
             return table
@@ -4,99 +4,325 @@ Created on Thu Sep 21 16:23:17 2023
 
 @author: cheppner
 """
+import math
+import os
+from dataclasses import dataclass
+from math import exp as _exp, pow as _pow
+
+import numpy as np
+import pandas as pd
+
+# The SMB kernels run with the first available backend: the ahead-of-time build of the numba kernel
+# (see build_ext.py), numba, the cython extension built by setup.py, or plain python.
+# The LRP_UPDATE_SMB_BACKEND environment variable picks one of them.
+SMB_BACKENDS = ('aot', 'numba', 'cython', 'python')
+
+smb_aot = numba = _smb_cy = None
+_requested_backend = os.environ.get('LRP_UPDATE_SMB_BACKEND')
+if _requested_backend not in (None,) + SMB_BACKENDS:
+    raise Exception(f"LRP_UPDATE_SMB_BACKEND must be one of {SMB_BACKENDS}, not {_requested_backend}")
+if _requested_backend in (None, 'aot'):
+    try:  # does not import numba
+        from lrp_update import smb_aot
+    except ImportError:
+        if _requested_backend == 'aot':
+            raise
+if smb_aot is None and _requested_backend in (None, 'numba'):
+    try:
+        import numba
+    except ImportError:
+        if _requested_backend == 'numba':
+            raise
+if smb_aot is None and numba is None and _requested_backend in (None, 'cython'):
+    try:
+        from lrp_update import _smb_cy
+    except ImportError:
+        if _requested_backend == 'cython':
+            raise
+BACKEND = ('aot' if smb_aot is not None else 'numba' if numba is not None else
+           'cython' if _smb_cy is not None else 'python')
+# the numba and cython kernels release the GIL, so threads can share the fields. numba.pycc exports
+# cannot release it, so with the aot backend (and plain python) the fields are split among processes
+KERNEL_RELEASES_GIL = BACKEND in ('numba', 'cython')
+
+if BACKEND == 'numba':
+    njit = numba.njit
+else:
+    def njit(*args, **kwargs):
+        """Stand-in for numba.njit, the decorated functions run as plain python"""
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda func: func
 
 RUNOFF_FRACTION = 0.0
 INITIAL_SOIL_STOR = 0
 SOIL_STOR_CAP = 16
 
+# 10 ** (0.02426 * et) == exp(LN10_K * et)
+LN10_K = 0.02426 * math.log(10.0)
+
 
+@njit(cache=True)
 def eff_precip(precip, et):
-    return min(precip, et, max(0, (0.70917 * (precip ** 0.82416) - 0.11556) * (10 ** (0.02426 * et))))
+    if precip == 0.0:
+        # dry time steps skip the powers, min(precip, et, ...) is then min(0, et)
+        return et if et < 0.0 else 0.0
+    # math.pow/math.exp are direct C calls, unlike the ** operator, and the 2-arg clamps
+    # replace min(precip, et, ...), which builds a tuple in plain python
+    eff_ppt = max(0.0, (0.70917 * _pow(precip, 0.82416) - 0.11556) * _exp(LN10_K * et))
+    if eff_ppt > precip:
+        eff_ppt = precip
+    if eff_ppt > et:
+        eff_ppt = et
+    return eff_ppt
 
 
+def eff_precip_vec(ppt, et, out=None):
+    """Vectorized `eff_precip`, with the powers written as exp/log, which are cheaper than np.power"""
+    et_term = np.exp(LN10_K * et)
+    ppt_pow = np.where(ppt > 0, np.exp(0.82416 * np.log(np.maximum(ppt, 1e-300))), 0.0)
+    eff_ppt = np.maximum(0.0, (0.70917 * ppt_pow - 0.11556) * et_term)
+    return np.minimum(np.minimum(ppt, et), eff_ppt, out=out)
+
+
+@njit(cache=True)
 def calc_runoff(ppt, frac):
     return ppt * frac
 
 
+@njit(cache=True)
 def rem_ppt(ppt, amount):
     return ppt - amount
 
 
+@njit(cache=True)
 def soil_stor_before_CU(cap, prev_ss, ppt_after_ro):
     return min(cap, prev_ss + ppt_after_ro)
 
 
+@njit(cache=True)
 def CU_of_soil_stor(ss_before_CU, et, eff_ppt):
     return min(ss_before_CU, et - eff_ppt)
 
 
+@njit(cache=True)
 def soil_stor_after_CU(ss_before_CU, CU_soil_stor):
     return ss_before_CU - CU_soil_stor
 
 
+@njit(cache=True)
 def CU_of_applied_water(et, eff_ppt, CU_ss):
     return et - eff_ppt - CU_ss
 
 
+@njit(cache=True)
 def CU_of_precip(eff_ppt, CU_ss):
     return eff_ppt + CU_ss
 
 
+# smb_calc and smb_calc_t0 inline the helpers above, which are kept for the callers using them one at a time
+@njit(cache=True)
 def smb_calc(precip, et, ro_frac, ss_capacity, prev_ss):
-    eff_ppt = eff_precip(precip, et)
-    rem_ppt_after_eff_ppt = rem_ppt(precip, eff_ppt)
-    ro = calc_runoff(rem_ppt_after_eff_ppt, ro_frac)
-    rem_ppt_after_runoff = rem_ppt(rem_ppt_after_eff_ppt, ro)
-    ss_before_CU = soil_stor_before_CU(ss_capacity, prev_ss, rem_ppt_after_runoff)
-    CU_ss = CU_of_soil_stor(ss_before_CU, et, eff_ppt)
-    ss_after_CU = soil_stor_after_CU(ss_before_CU, CU_ss)
-    cu_AW = CU_of_applied_water(et, eff_ppt, CU_ss)
-    cu_ppt = CU_of_precip(eff_ppt, CU_ss)
+    eff_ppt = min(precip, et, max(0.0, (0.70917 * _pow(precip, 0.82416) - 0.11556) * _exp(LN10_K * et)))
+    rem_ppt_after_eff_ppt = precip - eff_ppt
+    ro = rem_ppt_after_eff_ppt * ro_frac
+    ss_before_CU = min(ss_capacity, prev_ss + rem_ppt_after_eff_ppt - ro)
+    CU_ss = min(ss_before_CU, et - eff_ppt)
+    ss_after_CU = ss_before_CU - CU_ss
+    cu_AW = et - eff_ppt - CU_ss
+    cu_ppt = eff_ppt + CU_ss
     return eff_ppt, ro, CU_ss, ss_after_CU, cu_AW, cu_ppt
 
 
+@njit(cache=True)
 def smb_calc_t0(precip, et, ro_frac, ss_capacity, prev_ss):
-    eff_ppt = eff_precip(precip, et)
-    rem_ppt_after_eff_ppt = rem_ppt(precip, eff_ppt)
-    ro = calc_runoff(rem_ppt_after_eff_ppt, ro_frac)
-    rem_ppt_after_runoff = rem_ppt(rem_ppt_after_eff_ppt, ro)
+    eff_ppt = min(precip, et, max(0.0, (0.70917 * _pow(precip, 0.82416) - 0.11556) * _exp(LN10_K * et)))
+    ro = (precip - eff_ppt) * ro_frac
+    # no precipitation is added to the initial soil storage
     ss_before_CU = prev_ss
-    CU_ss = CU_of_soil_stor(ss_before_CU, et, eff_ppt)
-    ss_after_CU = soil_stor_after_CU(ss_before_CU, CU_ss)
-    cu_AW = CU_of_applied_water(et, eff_ppt, CU_ss)
-    cu_ppt = CU_of_precip(eff_ppt, CU_ss)
+    CU_ss = min(ss_before_CU, et - eff_ppt)
+    ss_after_CU = ss_before_CU - CU_ss
+    cu_AW = et - eff_ppt - CU_ss
+    cu_ppt = eff_ppt + CU_ss
     return eff_ppt, ro, CU_ss, ss_after_CU, cu_AW, cu_ppt
 
 
+@dataclass(slots=True)
+class SmbResult:
+    """SMB time series of a field, one array per variable.
+
+    Iterates and indexes in the (ss, ppt_eff, runoff, cu_ss, cu_aw, cu_ppt) order, like the tuple returned before.
+    """
+    ss: np.ndarray
+    ppt_eff: np.ndarray
+    runoff: np.ndarray
+    cu_ss: np.ndarray
+    cu_aw: np.ndarray
+    cu_ppt: np.ndarray
+
+    def __iter__(self):
+        return iter((self.ss, self.ppt_eff, self.runoff, self.cu_ss, self.cu_aw, self.cu_ppt))
+
+    def __getitem__(self, i):
+        return tuple(self)[i]
+
+    def __len__(self):
+        return 6
+
+    def to_dataframe(self, index=None):
+        """DataFrame over the result arrays, with the column names of the water balance
+
+        Args:
+            index: Index of the time steps.
+        """
+        return pd.DataFrame({"ss": self.ss, "ppt_eff": self.ppt_eff, "runoff": self.runoff,
+                             "cons_use_ss": self.cu_ss, "cons_use_AW": self.cu_aw, "cons_use_ppt": self.cu_ppt},
+                            index=index, copy=False)
+
+
 def calc_SMB_for_time_series(ppt_series,
                              et_series,
                              ):
-    ss = []
-    ppt_eff = []
-    runoff = []
-    cons_use_ss = []
-    cons_use_AW = []
-    cons_use_ppt = []
-    for t in range(len(ppt_series)):
-        if t == 0:
-            eff_ppt, ro, cu_ss, ss_after_CU, cu_AW, cu_ppt = smb_calc_t0(ppt_series[t], et_series[t], RUNOFF_FRACTION,
-                                                                         SOIL_STOR_CAP, INITIAL_SOIL_STOR)
-            ss.append(ss_after_CU)
-            ppt_eff.append(eff_ppt)
-            runoff.append(ro)
-            cons_use_ss.append(cu_ss)
-            cons_use_AW.append(cu_AW)
-            cons_use_ppt.append(cu_ppt)
-        else:
-            eff_ppt, ro, cu_ss, ss_after_CU, cu_AW, cu_ppt = smb_calc(ppt_series[t], et_series[t], RUNOFF_FRACTION,
-                                                                      SOIL_STOR_CAP, ss[t - 1])
-            ss.append(ss_after_CU)
-            ppt_eff.append(eff_ppt)
-            runoff.append(ro)
-            cons_use_ss.append(cu_ss)
-            cons_use_AW.append(cu_AW)
-            cons_use_ppt.append(cu_ppt)
-    return ss, ppt_eff, runoff, cons_use_ss, cons_use_AW, cons_use_ppt
+    ppt = np.asarray(ppt_series, dtype=np.float64).reshape(1, -1)
+    et = np.asarray(et_series, dtype=np.float64).reshape(1, -1)
+    eff_ppt, ro, cu_ss, ss, cu_aw, cu_ppt = smb_rows(ppt, et, RUNOFF_FRACTION, float(SOIL_STOR_CAP),
+                                                     float(INITIAL_SOIL_STOR))
+
+    # the inputs have a few significant digits, so the results are stored in float32
+    return SmbResult(*(a[0].astype(np.float32) for a in (ss, eff_ppt, ro, cu_ss, cu_aw, cu_ppt)))
+
+
+def smb_batch(ppt_2d, et_2d):
+    """Runs the SMB for many parcels at once, as `smb_gufunc` with the default parameters.
+
+    Args:
+        ppt_2d: precipitation array with shape (n_parcels, n_times)
+        et_2d: evapotranspiration array with shape (n_parcels, n_times)
+
+    Returns:
+        float32 array with shape (n_parcels, n_times, 6) with ss, ppt_eff, runoff,
+        cons_use_ss, cons_use_AW and cons_use_ppt along the last axis
+    """
+    eff_ppt, ro, cu_ss, ss, cu_aw, cu_ppt = smb_gufunc(np.asarray(ppt_2d, dtype=np.float64),
+                                                       np.asarray(et_2d, dtype=np.float64),
+                                                       RUNOFF_FRACTION, float(SOIL_STOR_CAP),
+                                                       float(INITIAL_SOIL_STOR))
+    return np.stack([ss, eff_ppt, ro, cu_ss, cu_aw, cu_ppt], axis=-1).astype(np.float32)
+
+
+@njit(cache=True, fastmath=True, boundscheck=False, nogil=True)
+def _smb_recurrence(ppt_after_ro, et, eff_ppt, cap, init, ss, cu_ss):
+    """Soil storage recurrence of a field, writes the soil storage `ss` and its consumptive use `cu_ss`.
+    This is the only sequential part of the SMB, the other terms are computed before and after it"""
+    n = len(et)
+    if n == 0:
+        return
+    # no precipitation is added to the initial soil storage
+    cu = et[0] - eff_ppt[0]
+    cu = init if cu > init else cu
+    prev_ss = init - cu
+    cu_ss[0] = cu
+    ss[0] = prev_ss
+    for t in range(1, n):
+        # conditional expressions, which numba lowers to branchless min instructions
+        ss_before_CU = prev_ss + ppt_after_ro[t]
+        ss_before_CU = cap if ss_before_CU > cap else ss_before_CU
+        cu = et[t] - eff_ppt[t]
+        cu = ss_before_CU if cu > ss_before_CU else cu
+        prev_ss = ss_before_CU - cu
+        cu_ss[t] = cu
+        ss[t] = prev_ss
+
+
+@njit(cache=True, nogil=True)
+def _smb_recurrence_rows(ppt_after_ro, et, eff_ppt, cap, init, ss, cu_ss):
+    """`_smb_recurrence` over the rows of 2-D arrays, one field per row"""
+    for i in range(et.shape[0]):
+        _smb_recurrence(ppt_after_ro[i], et[i], eff_ppt[i], cap, init, ss[i], cu_ss[i])
+
+
+def _smb_recurrence_lists(ppt_after_ro, et, eff_ppt, cap, init, ss, cu_ss):
+    """`_smb_recurrence_rows` in plain python, which runs `_smb_recurrence` over lists because the
+    interpreter indexes them much faster than arrays"""
+    for i in range(et.shape[0]):
+        ss_i, cu_ss_i = [0.0] * et.shape[1], [0.0] * et.shape[1]
+        _smb_recurrence(ppt_after_ro[i].tolist(), et[i].tolist(), eff_ppt[i].tolist(), cap, init, ss_i, cu_ss_i)
+        ss[i], cu_ss[i] = ss_i, cu_ss_i
+
+
+@njit(cache=True, nogil=True)
+def _smb_field(ppt, et, ro_frac, cap, init, eff_ppt, ro, cu_ss, ss, cu_aw, cu_ppt):
+    """SMB of a single field, written to the output arrays `eff_ppt` to `cu_ppt`. `cu_aw` holds
+    the precipitation left after runoff until the recurrence has run"""
+    for t in range(ppt.shape[0]):
+        eff_ppt[t] = eff_precip(ppt[t], et[t])
+        rem_ppt_after_eff_ppt = ppt[t] - eff_ppt[t]
+        ro[t] = rem_ppt_after_eff_ppt * ro_frac
+        cu_aw[t] = rem_ppt_after_eff_ppt - ro[t]
+    _smb_recurrence(cu_aw, et, eff_ppt, cap, init, ss, cu_ss)
+    for t in range(ppt.shape[0]):
+        cu_aw[t] = et[t] - eff_ppt[t] - cu_ss[t]
+        cu_ppt[t] = eff_ppt[t] + cu_ss[t]
+
+
+def smb_rows(ppt_2d, et_2d, ro_frac, cap, init):
+    """Serial `smb_gufunc` over the rows of 2-D inputs.
+
+    Everything but the soil storage recurrence is computed up front with array operations, and the
+    recurrence runs with the kernel of the backend. The array operations and the numba and cython
+    kernels release the GIL, so threads can share the rows.
+    """
+    ppt_2d = np.ascontiguousarray(ppt_2d, dtype=np.float64)
+    et_2d = np.ascontiguousarray(et_2d, dtype=np.float64)
+    eff_ppt, ro, cu_ss, ss, cu_aw, cu_ppt = out = np.empty((6,) + ppt_2d.shape)
+
+    eff_precip_vec(ppt_2d, et_2d, out=eff_ppt)
+    rem_ppt_after_eff_ppt = np.subtract(ppt_2d, eff_ppt, out=cu_aw)
+    np.multiply(rem_ppt_after_eff_ppt, ro_frac, out=ro)
+    # cu_aw holds the precipitation left after runoff until the recurrence has run
+    rem_ppt_after_runoff = np.subtract(rem_ppt_after_eff_ppt, ro, out=cu_aw)
+    _smb_recurrence_kernel(rem_ppt_after_runoff, et_2d, eff_ppt, float(cap), float(init), ss, cu_ss)
+    np.subtract(et_2d, eff_ppt, out=cu_aw)
+    cu_aw -= cu_ss
+    np.add(eff_ppt, cu_ss, out=cu_ppt)
+    return tuple(out)
+
+
+def _smb_gufunc_rows(ppt, et, ro_frac, cap, init):
+    """Runs the SMB for every field along the leading axes of `ppt` and `et`.
+
+    Args:
+        ppt: precipitation array with shape (..., n_times), e.g. (n_fields, n_times)
+        et: evapotranspiration array with the same shape as `ppt`
+        ro_frac: runoff fraction
+        cap: soil storage capacity
+        init: initial soil storage
+
+    Returns:
+        tuple of eff_ppt, ro, cu_ss, ss, cu_aw and cu_ppt arrays, each with the shape of `ppt`
+    """
+    ppt, et = np.broadcast_arrays(np.asarray(ppt, dtype=np.float64), np.asarray(et, dtype=np.float64))
+    shape_2d = (math.prod(ppt.shape[:-1]), ppt.shape[-1])
+    out = smb_rows(ppt.reshape(shape_2d), et.reshape(shape_2d), ro_frac, cap, init)
+    return tuple(values.reshape(ppt.shape) for values in out)
+
+
+# the recurrence kernel of the backend; numba also runs `smb_gufunc` in parallel, the others run the rows in series
+if BACKEND == 'aot':
+    _smb_recurrence_kernel = smb_aot.smb_recurrence_rows
+    smb_gufunc = _smb_gufunc_rows
+elif BACKEND == 'numba':
+    _smb_recurrence_kernel = _smb_recurrence_rows
+    smb_gufunc = numba.guvectorize(['(f8[:],f8[:],f8,f8,f8,f8[:],f8[:],f8[:],f8[:],f8[:],f8[:])'],
+                                   '(n),(n),(),(),()->(n),(n),(n),(n),(n),(n)',
+                                   nopython=True, target='parallel', cache=True)(_smb_field.py_func)
+    smb_gufunc.__doc__ = _smb_gufunc_rows.__doc__
+elif BACKEND == 'cython':
+    _smb_recurrence_kernel = _smb_cy.smb_recurrence_rows
+    smb_gufunc = _smb_gufunc_rows
+else:
+    _smb_recurrence_kernel = _smb_recurrence_lists
+    smb_gufunc = _smb_gufunc_rows
 
 # ppt_series = [3.058, 0.518, 6.815, 1.893, 0.235, 0, 0.005, 0, 0.015, 0.406, 3.923]
 # et_series = [0.869, 1.394, 2.868, 4.429, 3.928, 2.863, 3.044, 2.048, 1.296, 1.044, 0.677]
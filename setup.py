@@ -1,5 +1,26 @@
 from setuptools import setup
 
+try:
+    from Cython.Build import cythonize
+except ImportError:  # the compiled SMB kernels are optional, numba or plain python is used without them
+    ext_modules = []
+else:
+    ext_modules = cythonize("lrp_update/_smb_cy.pyx")
+
+try:
+    from numba.pycc.platform import external_compiler_works
+    from lrp_update.build_ext import cc
+except ImportError:  # numba.pycc is deprecated, the kernels are jit compiled without it
+    pass
+else:
+    # numba.pycc fails the whole build without a C compiler instead of skipping the optional extension
+    if external_compiler_works():
+        ext_modules.append(cc.distutils_extension())
+
+# optional, so installs without a C compiler still succeed
+for ext in ext_modules:
+    ext.optional = True
+
 setup(
     name='lrp_update',
     version='0.0.3dev',
@@ -9,5 +30,7 @@ setup(
     author='Marco Maneta',
     author_email='mmaneta@ekiconsult.com',
     description='',
-    install_requires=["requests", "matplotlib", "jupyter", "pandas", "pyarrow", "numpy", "pypdf==4.2.0",  "fpdf2==2.7.9",  "pillow"]
+    install_requires=["requests", "matplotlib", "jupyter", "pandas", "pyarrow", "numpy", "pypdf==4.2.0",  "fpdf2==2.7.9",  "pillow"],
+    extras_require={"async": ["aiohttp"], "numba": ["numba"]},
+    ext_modules=ext_modules
 )
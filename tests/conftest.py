@@ -0,0 +1,3 @@
+def pytest_configure(config):
+    config.addinivalue_line("markers", "slow: end to end tests that write csv files and reports or start "
+                                       "worker processes, deselect with -m 'not slow'")
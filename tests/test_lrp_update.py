@@ -1,10 +1,17 @@
+import asyncio
 import unittest
-from unittest.mock import MagicMock, patch
+from unittest.mock import AsyncMock, MagicMock, patch
 
+import io
 import os
+import tempfile
+import matplotlib
+import numpy as np
 import pandas as pd
+import pytest
 
 from lrp_update import query_openet
+from lrp_update import smb_for_LRP
 
 
 class TestOpenetApi(unittest.TestCase):
@@ -49,9 +56,20 @@ class TestOpenetApi(unittest.TestCase):
         self.assertEqual(out[0]["Authorization"], self.open_et.api_key)
         self.assertEqual(out[1]["attributes"], ["EKIfld"])
 
+    def test_csv_time_bounds(self):
+        t_min, t_max = query_openet._csv_time_bounds('data/Year1_enrolled_repurposed_pr.csv')
+        self.assertEqual(t_min, pd.Timestamp('2018-01-01'))
+        self.assertEqual(t_max, pd.Timestamp('2024-06-01'))
+
+        t_min, t_max = query_openet._csv_time_bounds('data/data_different_date_format/Year1_enrolled_repurposed_pr.csv')
+        self.assertEqual(t_min, pd.Timestamp('2018-01-01'))
+        self.assertEqual(t_max, pd.Timestamp('2024-03-01'))
+
+    @patch("os.makedirs")
+    @patch("pandas.DataFrame.to_parquet")
     @patch("pandas.DataFrame.to_csv") #prevents the creation of file
     @patch("requests.post")
-    def test_update_local_dataset_empty_local_database(self, mock_post, mock_to_csv):
+    def test_update_local_dataset_empty_local_database(self, mock_post, mock_to_csv, mock_to_parquet, mock_makedirs):
         vars = ("ET",
          "2018-01-01",
          "2023-09-30",
@@ -74,9 +92,12 @@ class TestOpenetApi(unittest.TestCase):
         assert ret is not None
         assert isinstance(obj_api.df_data, pd.DataFrame)
 
+    @patch("os.makedirs")
+    @patch("pandas.DataFrame.to_parquet")
     @patch("pandas.DataFrame.to_csv") #prevents the creation of file
     @patch("requests.post")
-    def test_update_local_dataset_local_database_different_date_format(self, mock_post, mock_to_csv):
+    def test_update_local_dataset_local_database_different_date_format(self, mock_post, mock_to_csv, mock_to_parquet,
+                                                                       mock_makedirs):
         vars = ("pr",
          "2018-01-01",
          "2024-09-30",
@@ -97,13 +118,144 @@ class TestOpenetApi(unittest.TestCase):
         obj_api = query_openet.OpenetApi('data/data_different_date_format', 'dfw33r')
         ret = obj_api.update_local_dataset(*vars)
         ref_df = pd.read_csv('data/data_different_date_format/Year1_enrolled_repurposed_pr.csv')
-        ref_df['time'] = pd.to_datetime(ref_df['time'])
+        ref_df['time'] = pd.to_datetime(ref_df['time'], format='%m/%d/%Y').astype('datetime64[ns]')
+        ref_df = ref_df.astype({'EKIfld': 'int32', 'pr': 'float32', 'acres': 'float32', 'acre-feet': 'float32'})
         assert ret.iloc[:3375, :].equals(ref_df)
+        mock_to_parquet.assert_called_once()
+        # the m/d/Y csv is rewritten rather than appended with ISO dates
+        self.assertNotIn('mode', mock_to_csv.call_args.kwargs)
+        self.assertTrue(mock_to_csv.call_args.args[0].endswith('Year1_enrolled_repurposed_pr.csv'))
 
 
+    @patch("os.makedirs")
+    @patch("pandas.DataFrame.to_parquet")
     @patch("pandas.DataFrame.to_csv")  # prevents the creation of file
+    @patch("requests.get")
+    @patch("requests.post")
+    def test_update_local_dataset_streamed_response(self, mock_post, mock_get, mock_to_csv, mock_to_parquet,
+                                                    mock_makedirs):
+        response = MagicMock(status_code=200)
+        response.json.return_value = {'url': 'https://storage.googleapis.com/openet/Yr1_nonrepurp_ET.csv'}
+        mock_post.return_value = response
+        with open('data/Yr1_nonrepurp_ET.csv', 'rb') as f:
+            mock_get.return_value.__enter__.return_value.raw = io.BytesIO(f.read())
+
+        obj_api = query_openet.OpenetApi('data', 'dfw33r')
+        ret = obj_api.update_local_dataset(*self.vars)
+
+        mock_get.assert_called_once_with('https://storage.googleapis.com/openet/Yr1_nonrepurp_ET.csv', stream=True)
+        assert len(ret) == 6192
+
+    @patch("requests.post")
+    def test_update_local_dataset_cached_response(self, mock_post):
+        response = MagicMock(status_code=200)
+        response.json.return_value = {'url': 'data/Yr1_nonrepurp_ET.csv'}
+        mock_post.return_value = response
+
+        with tempfile.TemporaryDirectory() as path_dataset:
+            obj_api = query_openet.OpenetApi(path_dataset, 'dfw33r')
+            first = obj_api.update_local_dataset(*self.vars)
+            # the response covers the requested period, so it is reused once the local dataset is gone
+            os.remove(os.path.join(path_dataset, 'Year1_enrolled_nonrepurposed_ET.csv'))
+            second = obj_api.update_local_dataset(*self.vars)
+
+        mock_post.assert_called_once()
+        pd.testing.assert_frame_equal(first, second)
+
     @patch("requests.post")
-    def test_update_local_dataset_local_database_contains_period(self, mock_post, mock_to_csv):
+    def test_update_local_dataset_incomplete_cached_response(self, mock_post):
+        vars = ("ET",
+                "2018-01-01",
+                "2030-09-30",  # beyond the data in the response, so the local dataset is never up to date
+                "monthly",
+                "ensemble",
+                "mean",
+                "cimis",
+                "in",
+                "EKIfld",
+                "projects/ee-csheppner/assets/Year1_enrolled_nonrepurposed",
+                "multipolygon",
+                "JSON")
+
+        response = MagicMock(status_code=200)
+        response.json.return_value = {'url': 'data/Yr1_nonrepurp_ET.csv'}
+        mock_post.return_value = response
+
+        with tempfile.TemporaryDirectory() as path_dataset:
+            obj_api = query_openet.OpenetApi(path_dataset, 'dfw33r')
+            obj_api.update_local_dataset(*vars)
+            obj_api.update_local_dataset(*vars)
+            self.assertFalse(os.path.exists(os.path.join(path_dataset, '.cache')))
+
+        # the response does not cover the requested period, so the server is asked again
+        self.assertEqual(mock_post.call_count, 2)
+
+    @patch("os.makedirs")
+    @patch("pandas.DataFrame.to_parquet")
+    @patch("pandas.DataFrame.to_csv")  # prevents the creation of file
+    @patch("lrp_update.query_openet.OpenetApi._post_async", new_callable=AsyncMock)
+    def test_update_local_datasets(self, mock_post_async, mock_to_csv, mock_to_parquet, mock_makedirs):
+        query = {"start_date": "2018-01-01",
+                 "end_date": "2023-09-30",
+                 "interval": "monthly",
+                 "model": "ensemble",
+                 "reducer": "mean",
+                 "reference_et": "cimis",
+                 "units": "in",
+                 "attributes": "EKIfld"}
+        jobs = [{"variable": "ET", "asset_id": "projects/ee-csheppner/assets/Year1_enrolled_nonrepurposed", **query},
+                {"variable": "pr", "asset_id": "projects/ee-csheppner/assets/Year1_enrolled_repurposed", **query}]
+        mock_post_async.return_value = {'url': 'data/Yr1_nonrepurp_ET.csv'}
+
+        obj_api = query_openet.OpenetApi('data', 'dfw33r')
+        ret = obj_api.update_local_datasets(jobs)
+
+        # the precipitation dataset already covers the period
+        mock_post_async.assert_called_once()
+        assert isinstance(ret[0], pd.DataFrame)
+        assert ret[1] is None
+
+    def test_update_local_datasets_running_loop(self):
+        async def notebook_cell():
+            obj_api = query_openet.OpenetApi('data', 'dfw33r')
+            obj_api.update_local_datasets([])
+
+        # e.g. jupyter, where the coroutine must be awaited instead
+        with self.assertRaises(Exception):
+            asyncio.run(notebook_cell())
+
+    def test_download_async(self):
+        response = MagicMock()
+        with open('data/Yr1_nonrepurp_ET.csv', 'rb') as f:
+            response.read = AsyncMock(return_value=f.read())
+        session = MagicMock()
+        session.get.return_value.__aenter__.return_value = response
+
+        r = {'url': 'https://storage.googleapis.com/openet/Yr1_nonrepurp_ET.csv'}
+        df = asyncio.run(query_openet.OpenetApi._download_async(session, r))
+
+        session.get.assert_called_once_with('https://storage.googleapis.com/openet/Yr1_nonrepurp_ET.csv')
+        assert len(df) == 6192
+
+    def test_update_from_data_out_of_order(self):
+        obj_api = query_openet.OpenetApi('data', 'dfw33r')
+        with tempfile.TemporaryDirectory() as tmp:
+            fn_ds = os.path.join(tmp, 'ds.csv')
+            with open(fn_ds, 'w') as f:
+                f.write('time,EKIfld,pr,acres,acre-feet\n2020-02-01,1,1.0,1.0,1.0\n2020-03-01,1,1.0,1.0,1.0\n')
+            df_data = pd.DataFrame({'time': ['2020-04-01', '2020-01-01'], 'EKIfld': [1, 1], 'pr': [2.0, 2.0],
+                                    'acres': [1.0, 1.0], 'acre-feet': [2.0, 2.0]})
+            # the new rows are not all after the local ones, so the csv is rewritten in time order
+            obj_api._update_from_data(df_data, fn_ds, query_openet._csv_time_bounds(fn_ds))
+            times = pd.to_datetime(pd.read_csv(fn_ds)['time'])
+            self.assertTrue(times.is_monotonic_increasing)
+            self.assertEqual(query_openet._csv_time_bounds(fn_ds),
+                             (pd.Timestamp('2020-01-01'), pd.Timestamp('2020-04-01')))
+
+    @patch("pandas.DataFrame.to_parquet")
+    @patch("pandas.DataFrame.to_csv")  # prevents the creation of file
+    @patch("requests.post")
+    def test_update_local_dataset_local_database_contains_period(self, mock_post, mock_to_csv, mock_to_parquet):
         vars = ("pr",
                 "2018-01-01",
                 "2023-09-30",
@@ -170,13 +322,157 @@ class TestCalculateWaterBalance(unittest.TestCase):
     def test_run_consumptive_use_calcs_all_users(self):
         self.report.calculate_consumptive_use()
 
+    def test_run_consumptive_use_calcs_threads(self):
+        report = query_openet.CalculateWaterBalance(
+            fn_pp='data/Year1_enrolled_repurposed_pr.csv',
+            fn_et='data/Year1_enrolled_repurposed_ET.csv',
+            fn_fld_key='data/EKIfld_IDs_key.csv',
+            end_date="2023-09-30",
+        )
+        # the ET dataset has no data for the fields of this parcel
+        report.eki_fld_id_keys = report.eki_fld_id_keys[report.eki_fld_id_keys['concat_appl_ID'] != '000Native']
+
+        ref = report.calculate_consumptive_use().df_smb
+        out = report.calculate_consumptive_use(max_workers=2).df_smb
+        pd.testing.assert_frame_equal(out, ref)
+
+    @pytest.mark.slow
+    @patch('lrp_update.query_openet.KERNEL_RELEASES_GIL', False)
+    def test_run_consumptive_use_calcs_process_pool(self):
+        report = query_openet.CalculateWaterBalance(
+            fn_pp='data/Year1_enrolled_repurposed_pr.csv',
+            fn_et='data/Year1_enrolled_repurposed_ET.csv',
+            fn_fld_key='data/EKIfld_IDs_key.csv',
+            end_date="2023-09-30",
+        )
+        # the ET dataset has no data for the fields of this parcel
+        report.eki_fld_id_keys = report.eki_fld_id_keys[report.eki_fld_id_keys['concat_appl_ID'] != '000Native']
+
+        ref = report.calculate_consumptive_use().df_smb
+        out = report.calculate_consumptive_use(max_workers=2).df_smb
+        pd.testing.assert_frame_equal(out, ref)
+
+    @patch('os.cpu_count', return_value=8)
+    def test_n_workers(self, mock_cpu_count):
+        self.assertEqual(query_openet._n_workers(1), 1)
+        self.assertEqual(query_openet._n_workers(4), 4)
+        self.assertEqual(query_openet._n_workers(None), 8)
+        self.assertEqual(query_openet._n_workers(-1), 8)
+        self.assertEqual(query_openet._n_workers(-2), 7)
+        self.assertEqual(query_openet._n_workers(-16), 1)
+
+    def test_parcel_rows(self):
+        fld_ds = np.array([1, 1, 2, 3, 3, 3])
+        # field 3 is in both parcels, and listed twice for parcel 1
+        rows, parcel = query_openet._parcel_rows(fld_ds, np.array([3, 1, 3, 3]), np.array([0, 0, 1, 1]), 2)
+        np.testing.assert_array_equal(rows, [0, 1, 3, 4, 5, 3, 4, 5])
+        np.testing.assert_array_equal(parcel, [0, 0, 0, 0, 0, 1, 1, 1])
+
+    def test_weighted_average_nan(self):
+        # missing acres and acre-feet are skipped, like in a groupby sum
+        dataset = (np.array([1, 1, 2]), np.array([0, 0, 0]),
+                   np.array([1.0, np.nan, 2.0]), np.array([1 / 12, 1 / 12, np.nan]))
+        fld_keys = pd.DataFrame({'EKIfld': [1, 2]})
+        average, has_data = self.report._weighted_average(dataset, fld_keys, np.array([0, 1]), 2, 'test')
+        np.testing.assert_allclose(average[:, 0], [2.0, 0.0])
+        self.assertTrue(has_data[:, 0].all())
+        self.assertFalse(has_data[:, 1:].any())
+
+    @pytest.mark.slow
     def test_run_consumptive_save_to_file_one_user(self):
         self.report.calculate_consumptive_use(concat_appl_id="00001").save_consumptive_use_to_csv('data')
 
+    @pytest.mark.slow
     def test_run_consumptive_save_to_file_all_users(self):
         self.report.calculate_consumptive_use().save_consumptive_use_to_csv('data')
 
 
+class TestSmbForLrp(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.ppt_series = [3.058, 0.518, 6.815, 1.893, 0.235, 0, 0.005, 0, 0.015, 0.406, 3.923]
+        cls.et_series = [0.869, 1.394, 2.868, 4.429, 3.928, 2.863, 3.044, 2.048, 1.296, 1.044, 0.677]
+
+    def test_calc_SMB_for_time_series(self):
+        ref = []
+        ss = smb_for_LRP.INITIAL_SOIL_STOR
+        for t, (ppt, et) in enumerate(zip(self.ppt_series, self.et_series)):
+            smb_calc = smb_for_LRP.smb_calc_t0 if t == 0 else smb_for_LRP.smb_calc
+            eff_ppt, ro, cu_ss, ss, cu_AW, cu_ppt = smb_calc(ppt, et, smb_for_LRP.RUNOFF_FRACTION,
+                                                             smb_for_LRP.SOIL_STOR_CAP, ss)
+            ref.append([ss, eff_ppt, ro, cu_ss, cu_AW, cu_ppt])
+
+        out = smb_for_LRP.calc_SMB_for_time_series(self.ppt_series, self.et_series)
+
+        for values in out:
+            self.assertIsInstance(values, np.ndarray)
+        np.testing.assert_allclose(np.array(out).T, ref)
+
+    def test_calc_SMB_for_time_series_float32(self):
+        rng = np.random.default_rng(0)
+        ppt = np.where(rng.random(1000) < 0.5, 0.0, rng.gamma(1.0, 2.0, 1000))
+        et = rng.gamma(2.0, 1.5, 1000)
+        ref = []
+        ss = float(smb_for_LRP.INITIAL_SOIL_STOR)
+        for t in range(len(ppt)):
+            smb_calc = smb_for_LRP.smb_calc_t0 if t == 0 else smb_for_LRP.smb_calc
+            eff_ppt, ro, cu_ss, ss, cu_AW, cu_ppt = smb_calc(ppt[t], et[t], smb_for_LRP.RUNOFF_FRACTION,
+                                                             float(smb_for_LRP.SOIL_STOR_CAP), ss)
+            ref.append([ss, eff_ppt, ro, cu_ss, cu_AW, cu_ppt])
+
+        out = smb_for_LRP.calc_SMB_for_time_series(ppt, et)
+
+        for values in out:
+            self.assertEqual(values.dtype, np.float32)
+        np.testing.assert_allclose(np.array(out, dtype=np.float64).T, ref, rtol=1e-6, atol=1e-6)
+
+    def test_smb_result_to_dataframe(self):
+        index = pd.date_range("2023-01-01", periods=len(self.ppt_series), freq="MS")
+        out = smb_for_LRP.calc_SMB_for_time_series(self.ppt_series, self.et_series)
+
+        df = out.to_dataframe(index)
+
+        self.assertIsInstance(out, smb_for_LRP.SmbResult)
+        self.assertListEqual(list(df.columns),
+                             ["ss", "ppt_eff", "runoff", "cons_use_ss", "cons_use_AW", "cons_use_ppt"])
+        pd.testing.assert_index_equal(df.index, index)
+        np.testing.assert_array_equal(df["cons_use_AW"].to_numpy(), out.cu_aw)
+
+    def test_smb_batch(self):
+        ref = np.array(smb_for_LRP.calc_SMB_for_time_series(self.ppt_series, self.et_series)).T
+        ppt_2d = np.array([self.ppt_series, self.ppt_series[::-1]])
+        et_2d = np.array([self.et_series, self.et_series[::-1]])
+
+        out = smb_for_LRP.smb_batch(ppt_2d, et_2d)
+
+        self.assertEqual(out.shape, (2, len(self.ppt_series), 6))
+        np.testing.assert_allclose(out[0], ref)
+        np.testing.assert_allclose(
+            out[1], np.array(smb_for_LRP.calc_SMB_for_time_series(self.ppt_series[::-1], self.et_series[::-1])).T)
+
+    def test_smb_gufunc(self):
+        ppt_2d = np.array([self.ppt_series, self.ppt_series[::-1]])
+        et_2d = np.array([self.et_series, self.et_series[::-1]])
+        ref = [np.array(smb_for_LRP.calc_SMB_for_time_series(ppt, et)).T for ppt, et in zip(ppt_2d, et_2d)]
+
+        eff_ppt, ro, cu_ss, ss, cu_AW, cu_ppt = smb_for_LRP.smb_gufunc(
+            ppt_2d, et_2d, smb_for_LRP.RUNOFF_FRACTION, smb_for_LRP.SOIL_STOR_CAP, smb_for_LRP.INITIAL_SOIL_STOR)
+
+        np.testing.assert_allclose(np.stack([ss, eff_ppt, ro, cu_ss, cu_AW, cu_ppt], axis=-1), ref, rtol=1e-6)
+
+    def test_eff_precip(self):
+        for ppt, et in zip(self.ppt_series + [0.0, 0.1], self.et_series + [-0.5, -0.5]):
+            ref = min(ppt, et, max(0, (0.70917 * (ppt ** 0.82416) - 0.11556) * (10 ** (0.02426 * et))))
+            self.assertAlmostEqual(smb_for_LRP.eff_precip(ppt, et), ref, places=12)
+
+    def test_eff_precip_vec(self):
+        ppt = np.array(self.ppt_series + [0.0, 0.1])
+        et = np.array(self.et_series + [-0.5, -0.5])
+        ref = [smb_for_LRP.eff_precip(p, e) for p, e in zip(ppt, et)]
+        np.testing.assert_allclose(smb_for_LRP.eff_precip_vec(ppt, et), ref, rtol=1e-12)
+
+
 class TestCalculateLrpReport(unittest.TestCase):
 
     @classmethod
@@ -189,6 +485,7 @@ class TestCalculateLrpReport(unittest.TestCase):
         self.report = query_openet.GenerateLrpReport.from_pdf_template(fn_pdf)
         assert self.report.lrp_participant_name is not None
 
+    @pytest.mark.slow
     def test_generate_lrp_report(self):
         self.report.generate_lrp_report('data/Year1_enrolled_repurposed_pr.csv',
                                         'data/Year1_enrolled_repurposed_ET.csv',
@@ -197,6 +494,8 @@ class TestCalculateLrpReport(unittest.TestCase):
                                         "Q4",
                                         "test.pdf"
                                         )
+        # the report font does not leak into the user's matplotlib settings
+        self.assertEqual(matplotlib.rcParams['font.weight'], matplotlib.rcParamsDefault['font.weight'])
 
 
 # class TestPdf(unittest.TestCase):